@@ -3,11 +3,13 @@ Support for slackpkg
 """
 
 import collections
-import copy
-import glob
+import concurrent.futures
+import contextvars
+import functools
 import logging
 import os
 import re
+import shlex
 
 import salt.utils.decorators.path
 import salt.utils.itertools
@@ -21,6 +23,12 @@ log = logging.getLogger(__name__)
 __virtualname__ = "pkg"
 
 pkgdb = "var/log/packages"
+pkglist = "/var/lib/slackpkg/pkglist"
+
+_PKGEXTS = (".tgz", ".tbz", ".tlz", ".txz")
+_PKGREGEX = re.compile(r"(.*)\.t[bglx]z$")
+
+_PkgInfo = collections.namedtuple("PkgInfo", ("name", "version", "arch", "build"))
 
 
 def __virtual__():
@@ -50,21 +58,39 @@ def __virtual__():
     )
 
 
+@functools.lru_cache(maxsize=4096)
 def _pkginfo(package):
     name, version, arch, build = package.rsplit("-", 3)
-    pkginfo_tuple = collections.namedtuple(
-        "PkgInfo",
-        ("name", "version", "arch", "build"),
-    )
-    return pkginfo_tuple(name, version, arch, build)
+    return _PkgInfo(name, version, arch, build)
+
+
+def _pkgname(path):
+    return os.path.basename(path).rsplit("-", 3)[0]
 
 
 def _pkglist(prefix):
-    ret = []
-    lines = glob.glob("{}/*".format(prefix))
-    for line in lines:
-        package = line.rsplit("/", 1)[1]
-        ret.append(_pkginfo(package))
+    with os.scandir(prefix) as entries:
+        return [_pkginfo(entry.name) for entry in entries]
+
+
+def _load_pkglist():
+    """
+    Return a dict mapping the package names found in slackpkg's pkglist to
+    their ``<version>-<build>`` strings. The parsed result is cached in
+    ``__context__`` until the file's mtime changes.
+    """
+    mtime = os.stat(pkglist).st_mtime_ns
+    if __context__.get("slackpkg.pkglist_mtime") == mtime:
+        return __context__["slackpkg.pkglist"]
+
+    ret = {}
+    with salt.utils.files.fopen(pkglist, "r") as remote:
+        for line in remote:
+            fields = line.split(None, 7)
+            ret[fields[1]] = f"{fields[2]}-{fields[4]}"
+
+    __context__["slackpkg.pkglist"] = ret
+    __context__["slackpkg.pkglist_mtime"] = mtime
     return ret
 
 
@@ -72,8 +98,8 @@ def _list_pkgs_from_context(versions_as_list):
     if versions_as_list:
         return __context__["pkg.list_pkgs"]
     else:
-        ret = copy.deepcopy(__context__["pkg.list_pkgs"])
-        __salt__["pkg_resource.stringfy"](ret)
+        ret = {k: list(v) for k, v in __context__["pkg.list_pkgs"].items()}
+        __salt__["pkg_resource.stringify"](ret)
         return ret
 
 
@@ -96,24 +122,29 @@ def list_pkgs(versions_as_list=False, **kwargs):
     """
     # not yet implemented or not applicable
     if any(
-        [salt.utils.data.is_true(kwargs.get(x)) for x in ("removed", "purge_desired")]
+        salt.utils.data.is_true(kwargs.get(x)) for x in ("removed", "purge_desired")
     ):
         return {}
 
-    if not kwargs.get("root"):
-        root = "/"
-    prefix = root + pkgdb
+    root = kwargs.get("root") or "/"
+    prefix = os.path.join(root, pkgdb)
+    # The context cache only holds the package list of the running system
+    use_context = root == "/"
 
-    if "pkg.list_pkgs" in __context__ and kwargs.get("use_context", True):
+    if (
+        use_context
+        and "pkg.list_pkgs" in __context__
+        and kwargs.get("use_context", True)
+    ):
         return _list_pkgs_from_context(versions_as_list)
 
     ret = {}
     for package in _pkglist(prefix):
-        __salt__["pkg_resource.add_pkg"](
-            ret, package[0], "{}-{}".format(package[1], package[3])
-        )
+        __salt__["pkg_resource.add_pkg"](ret, package[0], f"{package[1]}-{package[3]}")
 
     __salt__["pkg_resource.sort_pkglist"](ret)
+    if use_context:
+        __context__["pkg.list_pkgs"] = {k: list(v) for k, v in ret.items()}
 
     if not versions_as_list:
         __salt__["pkg_resource.stringify"](ret)
@@ -154,6 +185,9 @@ def refresh_db(**kwargs):
 
         if 1 == out["retcode"]:
             errors.append(out["stderr"])
+        else:
+            __context__.pop("slackpkg.pkglist", None)
+            __context__.pop("slackpkg.pkglist_mtime", None)
 
     if errors:
         raise CommandExecutionError(
@@ -173,30 +207,44 @@ def latest_version(*packages, **kwargs):
     If the latest version of a given package is already installed, an empty
     string will be returned for that package.
 
+    refresh : False
+        Set to ``True`` to run a package database refresh before looking up
+        the versions. By default the current slackpkg pkglist is used.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' pkg.latest_version <package name>
         salt '*' pkg.latest_version <package1> <package2> <package3> ...
+        salt '*' pkg.latest_version <package name> refresh=True
     """
     ret = {}
     if not packages:
         return ""
 
-    if salt.utils.data.is_true(kwargs.pop("refresh", True)):
+    if salt.utils.data.is_true(kwargs.pop("refresh", False)):
         refresh_db()
 
-    localpkgs = list_pkgs()
-
-    with salt.utils.files.fopen("/var/lib/slackpkg/pkglist", "r") as pkglist:
-        for line in pkglist:
-            if any(" " + package + " " in line for package in packages):
-                _, pkgname, version, _, build, _, _, _ = line.split(" ")
-                pkgversion = "{}-{}".format(version, build)
-                if localpkgs[pkgname] == pkgversion:
-                    pkgversion = ""
-                ret[pkgname] = pkgversion
+    if "pkg.list_pkgs" in __context__:
+        localpkgs = list_pkgs()
+        available = _load_pkglist()
+    else:
+        # Both sides hit the disk, so read the pkglist while scanning the
+        # package database. The copied context keeps the loader dunders
+        # usable from the worker thread.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(contextvars.copy_context().run, _load_pkglist)
+            localpkgs = list_pkgs()
+            available = pending.result()
+
+    for pkgname in packages:
+        if pkgname not in available:
+            continue
+        pkgversion = available[pkgname]
+        if localpkgs[pkgname] == pkgversion:
+            pkgversion = ""
+        ret[pkgname] = pkgversion
 
     # Return a string if only one package name passed
     if len(packages) == 1:
@@ -258,7 +306,7 @@ def install(
     reinstall = salt.utils.data.is_true(reinstall)
 
     if name and (name.startswith("/") or "://" in name):
-        pkgname = os.path.basename(name).rsplit("-", 3)[0]
+        pkgname = _pkgname(name)
         sources = [{pkgname: name}]
 
     try:
@@ -275,45 +323,51 @@ def install(
         refresh_db()
 
     old = list_pkgs()
+    old_names = frozenset(old)
 
     errors = []
+    changed = False
 
     log.debug("Installing these packages: %s", pkg_params)
     if pkg_type == "file":
+        to_install = []
         for package in pkg_params:
-            cmd = "/sbin/installpkg "
-            pkgname = os.path.basename(package).rsplit("-", 3)[0]
-            if not reinstall:
-                if pkgname in old:
-                    log.debug("Skipping %s: Already installed", pkgname)
-                    continue
+            pkgname = _pkgname(package)
+            if not reinstall and pkgname in old_names:
+                log.debug("Skipping %s: Already installed", pkgname)
+                continue
             log.debug("Installing %s with %s", pkgname, package)
-            cmd += package
+            to_install.append(shlex.quote(package))
+
+        if to_install:
+            cmd = "/sbin/installpkg " + " ".join(to_install)
             out = __salt__["cmd.run_all"](cmd, output_loglevel="trace")
+            changed = True
 
             if 0 != out["retcode"]:
                 errors.append(out["stderr"])
 
     elif pkg_type == "repository":
-        to_install = ""
-        to_reinstall = ""
+        to_install = []
+        to_reinstall = []
         for package in pkg_params:
-            if package in old:
+            if package in old_names:
                 if reinstall:
-                    to_reinstall += package + " "
+                    to_reinstall.append(package)
             else:
-                to_install += package + " "
+                to_install.append(package)
 
         if to_install:
             cmd = "/usr/sbin/slackpkg -batch=on -default_answer=y "
             cmd += "install "
-            cmd += to_install
+            cmd += " ".join(to_install)
             out = __salt__["cmd.run_all"](
                 cmd,
                 ignore_retcode=True,
                 output_loglevel="trace",
                 env='{"TERSE": "0"}',
             )
+            changed = True
 
             if 1 == out["retcode"]:
                 errors.append(out["stderr"])
@@ -321,22 +375,25 @@ def install(
         if to_reinstall:
             cmd = "/usr/sbin/slackpkg -batch=on -default_answer=y "
             cmd += "reinstall "
-            cmd += to_reinstall
+            cmd += " ".join(to_reinstall)
             out = __salt__["cmd.run_all"](
                 cmd,
                 ignore_retcode=True,
                 output_loglevel="trace",
                 env='{"TERSE": "0"}',
             )
+            changed = True
 
             if 1 == out["retcode"]:
                 errors.append(out["stderr"])
     else:
         errors.append("Package type {} not supported by slackpkg".format(pkg_type))
 
-    new = list_pkgs()
-
-    ret = salt.utils.data.compare_dicts(old, new)
+    ret = {}
+    if changed:
+        __context__.pop("pkg.list_pkgs", None)
+        new = list_pkgs()
+        ret = salt.utils.data.compare_dicts(old, new)
 
     if errors:
         raise CommandExecutionError(
@@ -371,7 +428,7 @@ def upgrade(
     """
     if name or pkgs or sources:
         if name and (name.startswith("/") or "://" in name):
-            pkgname = os.path.basename(name).rsplit("-", 3)[0]
+            pkgname = _pkgname(name)
             sources = [{pkgname: name}]
 
         try:
@@ -391,21 +448,27 @@ def upgrade(
         refresh_db()
 
     old = list_pkgs()
+    old_names = frozenset(old)
 
     errors = []
+    changed = False
 
     log.debug("Upgrading these packages: %s", pkg_params)
     cmd = "/usr/sbin/slackpkg -batch=on -default_answer=y "
     if pkg_type == "file":
+        to_upgrade = []
         for package in pkg_params:
-            cmd = "/sbin/upgradepkg "
-            pkgname = os.path.basename(package).rsplit("-", 3)[0]
-            if pkgname not in old:
+            pkgname = _pkgname(package)
+            if pkgname not in old_names:
                 log.debug("Skipping %s: Not installed", pkgname)
                 continue
             log.debug("Upgrading %s with %s", pkgname, package)
-            cmd += package
+            to_upgrade.append(shlex.quote(package))
+
+        if to_upgrade:
+            cmd = "/sbin/upgradepkg " + " ".join(to_upgrade)
             out = __salt__["cmd.run_all"](cmd, output_loglevel="trace")
+            changed = True
 
             if 0 != out["retcode"]:
                 errors.append(out["stderr"])
@@ -419,33 +482,37 @@ def upgrade(
                 output_loglevel="trace",
                 env='{"TERSE": "0"}',
             )
+            changed = True
 
             if 1 == out["retcode"]:
                 errors.append(out["stderr"])
         else:
-            to_upgrade = ""
+            to_upgrade = []
             for package in pkg_params:
-                if package in old:
-                    to_upgrade += package + " "
+                if package in old_names:
+                    to_upgrade.append(package)
 
             if to_upgrade:
                 cmd += "upgrade "
-                cmd += to_upgrade
+                cmd += " ".join(to_upgrade)
                 out = __salt__["cmd.run_all"](
                     cmd,
                     ignore_retcode=True,
                     output_loglevel="trace",
                     env='{"TERSE": "0"}',
                 )
+                changed = True
 
-        if 1 == out["retcode"]:
-            errors.append(out["stderr"])
+                if 1 == out["retcode"]:
+                    errors.append(out["stderr"])
     else:
         errors.append("Package type {} not supported by slackpkg".format(pkg_type))
 
-    new = list_pkgs()
-
-    ret = salt.utils.data.compare_dicts(old, new)
+    ret = {}
+    if changed:
+        __context__.pop("pkg.list_pkgs", None)
+        new = list_pkgs()
+        ret = salt.utils.data.compare_dicts(old, new)
 
     if errors:
         raise CommandExecutionError(
@@ -473,19 +540,26 @@ def remove(name=None, pkgs=None, test=False, **kwargs):
     log.debug("Removing these packages: %s", packages)
 
     old = list_pkgs()
+    old_names = frozenset(old)
 
     errors = []
+    to_remove = []
     for package in packages:
-        cmd = "/sbin/removepkg "
-        if package not in old:
+        if package not in old_names:
             continue
         log.debug("Removing %s", package)
-        cmd += package
-        out = __salt__["cmd.run_all"](cmd, output_loglevel="trace")
+        to_remove.append(shlex.quote(package))
 
-        if 0 != out["retcode"]:
-            errors.append(out["stderr"])
+    if not to_remove:
+        return {}
 
+    cmd = "/sbin/removepkg " + " ".join(to_remove)
+    out = __salt__["cmd.run_all"](cmd, output_loglevel="trace")
+
+    if 0 != out["retcode"]:
+        errors.append(out["stderr"])
+
+    __context__.pop("pkg.list_pkgs", None)
     new = list_pkgs()
 
     ret = salt.utils.data.compare_dicts(old, new)
@@ -518,18 +592,19 @@ def list_upgrades(refresh=True, **kwargs):  # pylint: disable=W0613
         refresh_db()
 
     cmd = "/usr/sbin/slackpkg -batch=on -default_answer=n upgrade-all "
-    pkgregex = re.compile(r'(.*)\.t.z$')
     upgrades = {}
 
-    lines = __salt__["cmd.run_stdout"](
+    out = __salt__["cmd.run_stdout"](
         cmd,
         ignore_retcode=True,
         output_loglevel="trace",
         env='{"TERSE": "0"}',
-    ).splitlines()
-    for line in lines:
-        pkgname = pkgregex.match(line)
+    )
+    for line in out.splitlines():
+        if not line.endswith(_PKGEXTS):
+            continue
+        pkgname = _PKGREGEX.match(line)
         if pkgname:
-            package = _pkginfo(pkgname[1])
-            upgrades[package[0]] = "{}-{}".format(package[1], package[3])
+            package = _pkginfo(pkgname.group(1))
+            upgrades[package[0]] = f"{package[1]}-{package[3]}"
     return upgrades